@@ -1,10 +1,837 @@
+import ast
+import hashlib
+import io
 import json
+import multiprocessing
 import os
+import queue
+import re
+import shutil
+import tarfile
+import threading
 import tkinter as tk
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from tkinter import filedialog, simpledialog, messagebox, colorchooser
 import cv2
+import numpy as np
 from PIL import Image, ImageTk
 
+try:
+    import onnxruntime as ort
+except ImportError:  # OpenCV DNN is used when ONNX Runtime is not installed
+    ort = None
+
+try:
+    import tifffile
+    import zarr
+except ImportError:  # Tiled export decodes whole images when these are not installed
+    tifffile = None
+
+
+ANNOTATION_FILE = "all_annotations.json"
+PREANNOTATION_CACHE_FILE = "preannotations_cache.json"
+IMAGE_HASH_CACHE_FILE = "image_hashes_cache.json"
+SPLITS = ("train", "val", "test")
+
+# Loaded detector for the current worker process, reused across batches
+_DETECTOR = None
+
+
+def natural_sort_key(name):
+    # Digit runs compare as numbers so frame_2.png sorts before frame_10.png
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def hash_image_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_model_class_names(model_path):
+    # {class_id: name} from a "<model>.names" / classes.txt sidecar (one name per line), else from the
+    # "names" entry Ultralytics writes into ONNX metadata. Empty when the model doesn't say.
+    sidecars = (os.path.splitext(model_path)[0] + ".names", os.path.join(os.path.dirname(model_path), "classes.txt"))
+    for sidecar in sidecars:
+        if os.path.exists(sidecar):
+            with open(sidecar, 'r') as f:
+                return dict(enumerate(line.strip() for line in f if line.strip()))
+    if ort is not None and model_path.lower().endswith(".onnx"):
+        try:
+            session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+            names = ast.literal_eval(session.get_modelmeta().custom_metadata_map["names"])
+        except Exception:
+            return {}
+        if isinstance(names, dict):
+            return {int(k): str(v) for k, v in names.items()}
+        return dict(enumerate(str(v) for v in names))
+    return {}
+
+
+def _load_detector(model_path):
+    global _DETECTOR
+    if _DETECTOR is not None and _DETECTOR["path"] == model_path:
+        return _DETECTOR
+    if ort is not None and model_path.lower().endswith(".onnx"):
+        options = ort.SessionOptions()
+        # Parallelism comes from the process pool, keep each session single threaded
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        model = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        backend = "onnxruntime"
+    else:
+        model = cv2.dnn.readNet(model_path)
+        model.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        model.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        backend = "opencv"
+    _DETECTOR = {"path": model_path, "backend": backend, "model": model, "batched": True}
+    return _DETECTOR
+
+
+def _forward(detector, blob):
+    if detector["backend"] == "onnxruntime":
+        session = detector["model"]
+        return session.run(None, {session.get_inputs()[0].name: blob})[0]
+    detector["model"].setInput(blob)
+    return detector["model"].forward()
+
+
+def _run_detector(detector, blob):
+    # Models exported with a fixed batch size of 1 reject batched input, fall back to one image at a time
+    if detector["batched"] and len(blob) > 1:
+        try:
+            return _forward(detector, blob)
+        except Exception:
+            detector["batched"] = False
+    return np.concatenate([_forward(detector, blob[i:i + 1]) for i in range(len(blob))])
+
+
+def _decode_detections(output, scale_x, scale_y, conf_threshold, nms_threshold, num_classes=None):
+    # YOLOv8 style output: (4 + num_classes, anchors) with cx, cy, w, h followed by class scores.
+    # Other heads (SSD (1, 1, N, 7), YOLOv5 with an objectness column, ...) are rejected rather than
+    # being misread as class scores.
+    if output.ndim != 2:
+        raise ValueError(f"Unsupported model output shape {tuple(output.shape)}: expected a YOLOv8-style "
+                         "(4 + classes, anchors) detection head")
+    preds = output.T if output.shape[0] < output.shape[1] else output
+    if preds.shape[1] < 5 or (num_classes and preds.shape[1] != 4 + num_classes):
+        raise ValueError(f"Unsupported model output shape {tuple(output.shape)}: expected "
+                         f"{4 + num_classes if num_classes else '4 + classes'} values per anchor (YOLOv8 layout)")
+    scores = preds[:, 4:]
+    class_ids = scores.argmax(axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+    keep = confidences >= conf_threshold
+    if not keep.any():
+        return []
+    cx, cy, w, h = preds[keep, :4].T
+    rects = np.stack([(cx - w / 2) * scale_x, (cy - h / 2) * scale_y, w * scale_x, h * scale_y], axis=1)
+    confidences = confidences[keep]
+    class_ids = class_ids[keep]
+    indices = cv2.dnn.NMSBoxes(rects.tolist(), confidences.tolist(), conf_threshold, nms_threshold)
+    detections = []
+    for i in np.array(indices).flatten():
+        x, y, bw, bh = rects[i]
+        detections.append({
+            "box": [int(x), int(y), int(x + bw), int(y + bh)],
+            "class_id": int(class_ids[i]),
+            "score": round(float(confidences[i]), 3)
+        })
+    return detections
+
+
+def _hash_files(paths):
+    # Runs in a worker process; the main process checks the digests against the cache
+    results = []
+    for path in paths:
+        try:
+            results.append((path, hash_image_file(path)))
+        except OSError:
+            continue
+    return results
+
+
+def _preannotate_batch(model_path, items, input_size, conf_threshold, nms_threshold, num_classes=None):
+    # Runs in a worker process: detect on a batch of (path, digest) cache misses. Only the original
+    # size and a network-sized copy of each image are kept, never the full-resolution decode.
+    cv2.setNumThreads(1)
+    pending = []
+    for path, digest in items:
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        h, w = img.shape[:2]
+        pending.append((path, digest, w, h, cv2.resize(img, (input_size, input_size))))
+        del img
+    if not pending:
+        return []
+    detector = _load_detector(model_path)
+    blob = cv2.dnn.blobFromImages([small for *_, small in pending], 1 / 255.0, (input_size, input_size),
+                                  swapRB=True, crop=False)
+    outputs = _run_detector(detector, blob)
+    return [(path, digest, _decode_detections(output, w / input_size, h / input_size,
+                                              conf_threshold, nms_threshold, num_classes))
+            for (path, digest, w, h, _), output in zip(pending, outputs)]
+
+
+# --- Perceptual hashing for near-duplicate detection ---
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def dhash(gray, hash_size=8):
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def phash(gray, hash_size=8, highfreq_factor=4):
+    size = hash_size * highfreq_factor
+    small = cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:hash_size, :hash_size]
+    # Skip the DC term when picking the threshold
+    return _bits_to_int(low > np.median(low.flatten()[1:]))
+
+
+def _hash_image_batch(paths):
+    # Runs in a worker process. A 1/8 scale decode is plenty for a 9x8 / 32x32 hash and
+    # lets the JPEG decoder skip most of the work.
+    cv2.setNumThreads(1)
+    results = []
+    for path in paths:
+        gray = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        if gray is None:
+            gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            continue
+        results.append((path, dhash(gray), phash(gray)))
+    return results
+
+
+class BKTree:
+    # Burkhard-Keller tree over (hash, payload) items for Hamming-distance range queries
+    def __init__(self):
+        self.root = None
+
+    def add(self, item):
+        if self.root is None:
+            self.root = (item, {})
+            return
+        node = self.root
+        while True:
+            dist = hamming_distance(item[0], node[0][0])
+            child = node[1].get(dist)
+            if child is None:
+                node[1][dist] = (item, {})
+                return
+            node = child
+
+    def query(self, value, max_distance):
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            item, children = stack.pop()
+            dist = hamming_distance(value, item[0])
+            if dist <= max_distance:
+                found.append((dist, item))
+            # Triangle inequality: only children within [dist - max, dist + max] can match
+            for child_dist, child in children.items():
+                if dist - max_distance <= child_dist <= dist + max_distance:
+                    stack.append(child)
+        return found
+
+
+def group_near_duplicates(hashes, threshold):
+    # hashes: ordered list of (name, dhash, phash). Leader clustering: each image joins the closest
+    # representative within the threshold on both dHash (BK-tree lookup) and pHash, or becomes a new
+    # representative. Members are compared with the representative only, never with each other,
+    # so a slow pan cannot chain distinct frames into one group.
+    order = {name: i for i, (name, _, _) in enumerate(hashes)}
+    tree = BKTree()
+    groups = {}
+    for name, d, p in hashes:
+        best = None
+        for d_dist, (_, (rep, rep_p)) in tree.query(d, threshold):
+            p_dist = hamming_distance(p, rep_p)
+            if p_dist <= threshold:
+                candidate = (d_dist + p_dist, order[rep], rep)
+                if best is None or candidate < best:
+                    best = candidate
+        if best is None:
+            groups[name] = [name]
+            tree.add((d, (name, p)))
+        else:
+            groups[best[2]].append(name)
+    return {rep: members for rep, members in groups.items() if len(members) > 1}
+
+
+# --- Polygon / rotated box geometry ---
+def polygon_bbox(points):
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def polygon_area(points):
+    # Shoelace formula
+    area = 0
+    for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+        area += x1 * y2 - x2 * y1
+    return abs(area) / 2
+
+
+def clip_polygon(points, x1, y1, x2, y2):
+    # Sutherland-Hodgman against an axis-aligned rectangle, one edge at a time. Concave polygons
+    # clip correctly too; pieces the rectangle cuts apart stay joined along its border.
+    def at_x(a, b, x):
+        t = (x - a[0]) / (b[0] - a[0])
+        return x, a[1] + t * (b[1] - a[1])
+
+    def at_y(a, b, y):
+        t = (y - a[1]) / (b[1] - a[1])
+        return a[0] + t * (b[0] - a[0]), y
+
+    for inside, intersect in ((lambda p: p[0] >= x1, lambda a, b: at_x(a, b, x1)),
+                              (lambda p: p[0] <= x2, lambda a, b: at_x(a, b, x2)),
+                              (lambda p: p[1] >= y1, lambda a, b: at_y(a, b, y1)),
+                              (lambda p: p[1] <= y2, lambda a, b: at_y(a, b, y2))):
+        clipped = []
+        for i, cur in enumerate(points):
+            prev = points[i - 1]
+            if inside(cur):
+                if not inside(prev):
+                    clipped.append(intersect(prev, cur))
+                clipped.append(cur)
+            elif inside(prev):
+                clipped.append(intersect(prev, cur))
+        points = clipped
+        if not points:
+            break
+    return points
+
+
+def point_in_polygon(x, y, points, bbox=None):
+    # Cheap bounding-box reject first, then even-odd ray casting
+    x1, y1, x2, y2 = bbox or polygon_bbox(points)
+    if not (x1 <= x <= x2 and y1 <= y <= y2):
+        return False
+    inside = False
+    for (ax, ay), (bx, by) in zip(points, points[1:] + points[:1]):
+        if (ay > y) != (by > y) and x < ax + (y - ay) * (bx - ax) / (by - ay):
+            inside = not inside
+    return inside
+
+
+def simplify_polygon(points, max_points=32, epsilon=1.0):
+    # Douglas-Peucker, loosening the tolerance until the vertex count fits
+    contour = np.array(points, dtype=np.int32).reshape(-1, 1, 2)
+    approx = cv2.approxPolyDP(contour, epsilon, True)
+    while len(approx) > max_points:
+        epsilon *= 1.5
+        approx = cv2.approxPolyDP(contour, epsilon, True)
+    return [(int(x), int(y)) for x, y in approx.reshape(-1, 2)]
+
+
+def rotated_box_points(points):
+    # Minimum-area rotated rectangle around the points, as 4 corners
+    rect = cv2.minAreaRect(np.array(points, dtype=np.float32))
+    return [(int(round(x)), int(round(y))) for x, y in cv2.boxPoints(rect)]
+
+
+def make_polygon(kind, points, cls):
+    points = [(int(x), int(y)) for x, y in points]
+    return {"kind": kind, "polygon": points, "bbox": polygon_bbox(points), "class": cls}
+
+
+# --- Box propagation between consecutive frames ---
+def track_region(prev_gray, next_gray, x1, y1, x2, y2, search_margin=48, min_score=0.5):
+    # Template-match the region from the previous frame inside its neighbourhood in the next one.
+    # Returns the (dx, dy) shift, or None when the region is too small or no longer found.
+    h, w = prev_gray.shape[:2]
+    x1, x2 = max(0, min(x1, x2)), min(w, max(x1, x2))
+    y1, y2 = max(0, min(y1, y2)), min(h, max(y1, y2))
+    if x2 - x1 < 4 or y2 - y1 < 4:
+        return None
+    margin = search_margin + max(x2 - x1, y2 - y1) // 4
+    nh, nw = next_gray.shape[:2]
+    sx1, sy1 = max(0, x1 - margin), max(0, y1 - margin)
+    sx2, sy2 = min(nw, x2 + margin), min(nh, y2 + margin)
+    if sx2 - sx1 < x2 - x1 or sy2 - sy1 < y2 - y1:
+        return None
+    result = cv2.matchTemplate(next_gray[sy1:sy2, sx1:sx2], prev_gray[y1:y2, x1:x2], cv2.TM_CCOEFF_NORMED)
+    _, score, _, loc = cv2.minMaxLoc(result)
+    if score < min_score:
+        return None
+    return sx1 + loc[0] - x1, sy1 + loc[1] - y1
+
+
+def propagate_annotations(prev_gray, next_gray, boxes, circles, polygons=()):
+    new_boxes = []
+    for box in boxes:
+        (x1, y1), (x2, y2) = box["box"]
+        shift = track_region(prev_gray, next_gray, x1, y1, x2, y2)
+        if shift:
+            dx, dy = shift
+            new_boxes.append({"box": [(x1 + dx, y1 + dy), (x2 + dx, y2 + dy)], "class": box["class"]})
+    new_circles = []
+    for circle in circles:
+        (cx, cy), (ex, ey) = circle["circle"]
+        r = max(2, int(((ex - cx) ** 2 + (ey - cy) ** 2) ** 0.5))
+        shift = track_region(prev_gray, next_gray, cx - r, cy - r, cx + r, cy + r)
+        if shift:
+            dx, dy = shift
+            new_circles.append({"circle": [(cx + dx, cy + dy), (ex + dx, ey + dy)], "class": circle["class"]})
+    new_polygons = []
+    for polygon in polygons:
+        shift = track_region(prev_gray, next_gray, *polygon["bbox"])
+        if shift:
+            dx, dy = shift
+            new_polygons.append(make_polygon(polygon["kind"], [(x + dx, y + dy) for x, y in polygon["polygon"]],
+                                             polygon["class"]))
+    return new_boxes, new_circles, new_polygons
+
+
+def decode_frame(path):
+    # The grayscale copy is made once per frame and shared by every tracking pass
+    image = cv2.imread(path)
+    return image, (None if image is None else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+
+def _track_prefetched(prev_gray_future, frame_future, boxes, circles, polygons):
+    # Runs on the prefetch thread, after both frames have been prepared by the same worker
+    _, next_gray = frame_future.result()
+    if next_gray is None:
+        return [], [], []
+    return propagate_annotations(prev_gray_future.result(), next_gray, boxes, circles, polygons)
+
+
+# --- Annotation index and tiled export ---
+def read_annotation_index(folder_path):
+    annotation_path = os.path.join(folder_path, ANNOTATION_FILE)
+    if not os.path.exists(annotation_path):
+        return {}
+    with open(annotation_path, 'r') as f:
+        return json.load(f)
+
+
+def annotation_rects(img_ann, classes):
+    # Flatten one image's saved annotations into (class_id, x1, y1, x2, y2) with x1 < x2, y1 < y2.
+    # Circles are exported as their bounding box.
+    rects = []
+    for cls, ann in img_ann.items():
+        if cls not in classes:
+            continue
+        class_id = classes.index(cls)
+        for x1, y1, x2, y2 in ann.get("boxes", []):
+            rects.append((class_id, min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+        for cx, cy, ex, ey in ann.get("circles", []):
+            r = int(((ex - cx) ** 2 + (ey - cy) ** 2) ** 0.5)
+            rects.append((class_id, cx - r, cy - r, cx + r, cy + r))
+    return rects
+
+
+def annotation_polygons(img_ann, classes):
+    # (class_id, kind, points) for the polygon and rotated box annotations of one image
+    polygons = []
+    for cls, ann in img_ann.items():
+        if cls not in classes:
+            continue
+        class_id = classes.index(cls)
+        for kind, key in (("polygon", "polygons"), ("rotated_box", "rotated_boxes")):
+            for flat in ann.get(key, []):
+                polygons.append((class_id, kind, list(zip(flat[0::2], flat[1::2]))))
+    return polygons
+
+
+def polygon_rects(polygons):
+    return [(class_id,) + tuple(polygon_bbox(points)) for class_id, _, points in polygons]
+
+
+def clip_polygons(polygons, img_w, img_h):
+    # Shapes are clipped to the image before anything is derived from them. A rotated box that had
+    # to be cut is no longer a rectangle, so it is passed on as a plain polygon.
+    clipped = []
+    for class_id, kind, points in polygons:
+        if all(0 <= x <= img_w and 0 <= y <= img_h for x, y in points):
+            clipped.append((class_id, kind, points))
+            continue
+        points = [(round(x, 2), round(y, 2)) for x, y in clip_polygon(points, 0, 0, img_w, img_h)]
+        if len(points) >= 3 and polygon_area(points) > 0:
+            clipped.append((class_id, "polygon", points))
+    return clipped
+
+
+def largest_remainder(total, fractions):
+    # Integer counts summing to total, each within one of total * fraction; leftover units go to
+    # the largest fractional parts instead of rounding every count on its own
+    quotas = [total * f for f in fractions]
+    counts = [int(q) for q in quotas]
+    order = sorted(range(len(quotas)), key=lambda i: (counts[i] - quotas[i], i))
+    for i in order[:total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def assign_splits(image_classes, ratios=(0.8, 0.1, 0.1), seed=0):
+    # image_classes: {image name: set of class ids}. Each image is stratified by the rarest class it
+    # contains, and every stratum is split by the given ratios in seeded-hash order, so the
+    # assignment is deterministic for a given seed and annotation set.
+    counts = {}
+    for class_ids in image_classes.values():
+        for class_id in class_ids:
+            counts[class_id] = counts.get(class_id, 0) + 1
+    strata = {}
+    for name, class_ids in image_classes.items():
+        key = min(class_ids, key=lambda c: (counts[c], c)) if class_ids else -1
+        strata.setdefault(key, []).append(name)
+    total = sum(ratios)
+    fractions = [r / total for r in ratios]
+
+    # Whole images per stratum first, then the leftover units are handed out across all strata by
+    # largest remainder so the overall split sizes still match the ratios
+    allocation = {}
+    leftovers = {}
+    for key, names in strata.items():
+        n = len(names)
+        split_counts = [int(n * f) for f in fractions]
+        # A rare class with two or more images always gets one into val, or it is never validated
+        if n >= 2 and fractions[1] > 0 and not split_counts[1]:
+            split_counts[1] = 1
+            if sum(split_counts) > n:
+                split_counts[max((0, 2), key=lambda i: split_counts[i])] -= 1
+        allocation[key] = split_counts
+        leftovers[key] = n - sum(split_counts)
+    targets = largest_remainder(len(image_classes), fractions)
+    assigned = [sum(split_counts[i] for split_counts in allocation.values()) for i in range(len(SPLITS))]
+    candidates = sorted(((len(strata[key]) * fractions[i] - split_counts[i], key, i)
+                         for key, split_counts in allocation.items() for i in range(len(SPLITS))),
+                        key=lambda c: (-c[0], c[1], c[2]))
+    for _, key, i in candidates:
+        if leftovers[key] and assigned[i] < targets[i]:
+            allocation[key][i] += 1
+            leftovers[key] -= 1
+            assigned[i] += 1
+    # Units the targets could not absorb (the val guarantee can overshoot them) follow the remainders
+    for _, key, i in candidates:
+        if leftovers[key]:
+            allocation[key][i] += 1
+            leftovers[key] -= 1
+
+    splits = {}
+    for key, names in strata.items():
+        names.sort(key=lambda n: hashlib.sha1(f"{seed}:{n}".encode()).hexdigest())
+        train_end = allocation[key][0]
+        val_end = train_end + allocation[key][1]
+        for i, name in enumerate(names):
+            splits[name] = SPLITS[0] if i < train_end else SPLITS[1] if i < val_end else SPLITS[2]
+    return splits
+
+
+def reset_dirs(*dirs):
+    # Splits can change between exports, so each one starts from an empty folder; otherwise an image
+    # could be left behind in its old split and end up in both train and val
+    for path in dirs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+
+def yolo_label_text(rects, img_w, img_h):
+    lines = []
+    # Circles near the border reach past the image; YOLO rejects coordinates outside [0, 1]
+    for class_id, x1, y1, x2, y2 in clip_rects(rects, 0, 0, img_w, img_h):
+        # Normalize coordinates (YOLO format)
+        x_center = ((x1 + x2) / 2) / img_w
+        y_center = ((y1 + y2) / 2) / img_h
+        width = (x2 - x1) / img_w
+        height = (y2 - y1) / img_h
+        lines.append(f"{class_id} {x_center} {y_center} {width} {height}\n")
+    return "".join(lines)
+
+
+def yolo_obb_label_text(rects, polygons, img_w, img_h):
+    # YOLO-OBB: class x1 y1 x2 y2 x3 y3 x4 y4, normalized. Axis-aligned boxes use their corners and
+    # free-form polygons their minimum-area rotated rectangle.
+    lines = []
+    for class_id, x1, y1, x2, y2 in clip_rects(rects, 0, 0, img_w, img_h):
+        corners = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+        lines.append((class_id, corners))
+    for class_id, kind, points in clip_polygons(polygons, img_w, img_h):
+        corners = points if kind == "rotated_box" else rotated_box_points(points)
+        # The fitted rectangle of a shape cut at the image corner can still reach past the edge, and
+        # Ultralytics drops label files with coordinates outside [0, 1]; the clipped shape's
+        # axis-aligned box is used then, which is still a rectangle and always inside
+        if not all(0 <= x <= img_w and 0 <= y <= img_h for x, y in corners):
+            x1, y1, x2, y2 = polygon_bbox(points)
+            corners = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+        lines.append((class_id, corners))
+    return "".join(
+        f"{class_id} " + " ".join(f"{x / img_w} {y / img_h}" for x, y in corners) + "\n"
+        for class_id, corners in lines
+    )
+
+
+def write_dataset_yaml(output_dir, classes):
+    with open(os.path.join(output_dir, "dataset.yaml"), 'w') as f:
+        f.write(f"path: {output_dir}\n")
+        for split in SPLITS:
+            f.write(f"{split}: images/{split}\n")
+        f.write("\n")
+        f.write(f"nc: {len(classes)}\n")
+        f.write(f"names: {classes}\n")
+
+
+def tile_origins(length, tile, stride):
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, stride))
+    origins.append(length - tile)
+    return origins
+
+
+def clip_rects(rects, x0, y0, x1, y1, min_visibility=0.0):
+    # Clip rects to a window and shift them into its coordinates, dropping ones mostly cut off
+    clipped = []
+    for class_id, rx1, ry1, rx2, ry2 in rects:
+        cx1, cy1 = max(rx1, x0), max(ry1, y0)
+        cx2, cy2 = min(rx2, x1), min(ry2, y1)
+        if cx2 <= cx1 or cy2 <= cy1:
+            continue
+        area = (rx2 - rx1) * (ry2 - ry1)
+        if area > 0 and (cx2 - cx1) * (cy2 - cy1) / area < min_visibility:
+            continue
+        clipped.append((class_id, cx1 - x0, cy1 - y0, cx2 - x0, cy2 - y0))
+    return clipped
+
+
+def image_size(path):
+    # Header-only read. Nothing is decoded, so Pillow's decompression-bomb limit (which large aerial
+    # images exceed) is lifted for just this call.
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        with Image.open(path) as im:
+            return im.size
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+def can_stream_tiff(path):
+    return tifffile is not None and path.lower().endswith(('.tif', '.tiff'))
+
+
+class TiffBandReader:
+    # Windowed TIFF reads through tifffile's zarr store: only the TIFF tiles/strips overlapping a
+    # band are decoded, whatever the compression. (A file stored as one giant strip still decodes
+    # whole for every band.)
+    def __init__(self, path):
+        self.tif = tifffile.TiffFile(path)
+        series = self.tif.series[0]
+        self.axes = series.axes
+        self.store = series.aszarr(level=0)
+        self.array = zarr.open(self.store, mode='r')
+        self.height = series.shape[self.axes.index("Y")]
+        self.width = series.shape[self.axes.index("X")]
+
+    def read_rows(self, y0, y1):
+        # Rows y0:y1 as a BGR (or grayscale) array; extra axes such as pages take their first entry
+        index = tuple(slice(y0, y1) if ax == "Y" else slice(None) if ax in "XS" else 0 for ax in self.axes)
+        band = np.asarray(self.array[index])
+        kept = [ax for ax in self.axes if ax in "YXS"]
+        if "S" in kept:
+            band = np.moveaxis(band, kept.index("S"), -1)
+            if band.shape[-1] == 3:
+                return cv2.cvtColor(band, cv2.COLOR_RGB2BGR)
+            if band.shape[-1] == 4:
+                return cv2.cvtColor(band, cv2.COLOR_RGBA2BGR)
+            return band[..., 0]
+        return band
+
+    def close(self):
+        self.store.close()
+        self.tif.close()
+
+
+def _export_image_tiles(src_img, images_dir, labels_dir, rects, tile, overlap, drop_empty, min_visibility):
+    # Runs in a worker process. TIFFs are streamed one band of tile rows at a time when tifffile/zarr
+    # are installed; everything else has no partial decode, so it is read once and sliced.
+    cv2.setNumThreads(1)
+    reader = None
+    full = None
+    if can_stream_tiff(src_img):
+        reader = TiffBandReader(src_img)
+        w, h = reader.width, reader.height
+    else:
+        full = cv2.imread(src_img, cv2.IMREAD_COLOR)
+        if full is None:
+            raise ValueError(f"Could not read {os.path.basename(src_img)}")
+        h, w = full.shape[:2]
+    # The source extension stays in the tile stem so a.png and a.tif never write the same tile names
+    base_name = os.path.basename(src_img).replace(".", "_")
+    ext = os.path.splitext(src_img)[1].lower()
+    ext = ext if ext in ('.png', '.jpg', '.jpeg') else '.png'
+    stride = max(1, tile - overlap)
+    records = []
+    try:
+        for ty in tile_origins(h, tile, stride):
+            th = min(tile, h - ty)
+            # Prefilter to the rects touching this band so each tile only checks nearby ones
+            band_rects = [r for r in rects if r[2] < ty + th and r[4] > ty]
+            if drop_empty and not band_rects:
+                continue
+            band = reader.read_rows(ty, ty + th) if reader else full[ty:ty + th]
+            for tx in tile_origins(w, tile, stride):
+                tw = min(tile, w - tx)
+                tile_rects = clip_rects(band_rects, tx, ty, tx + tw, ty + th, min_visibility)
+                if drop_empty and not tile_rects:
+                    continue
+                file_name = f"{base_name}_{tx}_{ty}{ext}"
+                cv2.imwrite(os.path.join(images_dir, file_name), band[:, tx:tx + tw])
+                with open(os.path.join(labels_dir, f"{base_name}_{tx}_{ty}.txt"), 'w') as f:
+                    f.write(yolo_label_text(tile_rects, tw, th))
+                records.append({"file_name": file_name, "width": tw, "height": th, "rects": tile_rects})
+    finally:
+        if reader:
+            reader.close()
+    return records
+
+
+# --- Sharded dataset export ---
+class ShardWriter:
+    # Packs samples into WebDataset-style tar shards ("{split}-000000.tar", members "{key}.{ext}")
+    # and records the byte offset of every member so samples can be read back without scanning.
+    def __init__(self, output_dir, split, max_shard_bytes):
+        self.output_dir = output_dir
+        self.split = split
+        self.max_shard_bytes = max_shard_bytes
+        self.shard_index = -1
+        self.tar = None
+        self.samples = []
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.shard_index += 1
+        self.shard_name = f"{self.split}-{self.shard_index:06d}.tar"
+        self.tar = tarfile.open(os.path.join(self.output_dir, self.shard_name), 'w')
+
+    def write(self, key, members):
+        sample_bytes = sum(len(data) for data in members.values())
+        # Samples are never split across shards
+        if self.tar is None or (self.tar.offset and self.tar.offset + sample_bytes > self.max_shard_bytes):
+            self._next_shard()
+        offsets = {}
+        for ext, data in members.items():
+            info = tarfile.TarInfo(name=f"{key}.{ext}")
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+            # The member data is the last (size rounded up to a block) bytes written
+            padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            offsets[ext] = [self.tar.offset - padded, len(data)]
+        self.samples.append({"key": key, "shard": self.shard_name, "members": offsets})
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+        with open(os.path.join(self.output_dir, f"{self.split}_index.json"), 'w') as f:
+            json.dump({"samples": self.samples}, f)
+        return len(self.samples)
+
+
+class ShardReader:
+    # Random access (by position or key) and sequential iteration over shards written by ShardWriter
+    def __init__(self, export_dir, split="train"):
+        self.export_dir = export_dir
+        with open(os.path.join(export_dir, f"{split}_index.json"), 'r') as f:
+            self.samples = json.load(f)["samples"]
+        self._positions = {sample["key"]: i for i, sample in enumerate(self.samples)}
+        self._files = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def keys(self):
+        return [sample["key"] for sample in self.samples]
+
+    def __getitem__(self, item):
+        sample = self.samples[item if isinstance(item, int) else self._positions[item]]
+        f = self._files.get(sample["shard"])
+        if f is None:
+            f = self._files[sample["shard"]] = open(os.path.join(self.export_dir, sample["shard"]), 'rb')
+        members = {}
+        for ext, (offset, size) in sample["members"].items():
+            f.seek(offset)
+            members[ext] = f.read(size)
+        return members
+
+    def __iter__(self):
+        # Index order is write order, so this reads every shard front to back
+        for i in range(len(self.samples)):
+            yield self[i]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def _put_until_stopped(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_shard_samples(samples, out_queue, stop):
+    # Producer: read one sample at a time; the bounded queue caps how much is held in memory.
+    # A failure is handed to the writer through the queue instead of ending the stream normally.
+    try:
+        for key, src_img, rects in samples:
+            with open(src_img, 'rb') as f:
+                image_bytes = f.read()
+            img_w, img_h = image_size(io.BytesIO(image_bytes))
+            ext = os.path.splitext(src_img)[1].lower().lstrip(".")
+            if not _put_until_stopped(out_queue, (key, {ext: image_bytes, "txt": yolo_label_text(rects, img_w, img_h).encode()}), stop):
+                return
+    except Exception as e:
+        _put_until_stopped(out_queue, e, stop)
+        return
+    _put_until_stopped(out_queue, None, stop)
+
+
+def _write_split_shards(output_dir, split, samples, max_shard_bytes, queue_size=16):
+    # Runs in a worker process, one per split
+    out_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    producer = threading.Thread(target=_read_shard_samples, args=(samples, out_queue, stop), daemon=True)
+    producer.start()
+    writer = ShardWriter(output_dir, split, max_shard_bytes)
+    try:
+        while True:
+            item = out_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            writer.write(*item)
+    except BaseException:
+        # Unblock the producer and leave no half-written shard open; the index is not written
+        stop.set()
+        if writer.tar is not None:
+            writer.tar.close()
+        raise
+    finally:
+        producer.join()
+    return split, writer.close()
+
 
 class SimpleAnnotator:
     def __init__(self):
@@ -16,6 +843,10 @@ class SimpleAnnotator:
         self.original_image = None
         self.boxes = []
         self.current_box = []
+        # Polygons and rotated boxes, stored as vertex lists with a cached bounding box for hit testing
+        self.polygons = []
+        self.current_stroke = []
+        self.max_polygon_points = 32
         self.drawing = False
         self.classes = ["Object"]  # Default class
         self.class_colors = {}  # Store per-class colors
@@ -30,6 +861,49 @@ class SimpleAnnotator:
         # --- Add these lines to initialize pan offsets ---
         self.offset_x = 0
         self.offset_y = 0
+        # Model pre-annotation: pending proposals per image name, kept apart from accepted boxes
+        self.proposals = {}
+        self.preannotation_batch_size = 8
+        self.preannotation_input_size = 640
+        self.preannotation_conf_threshold = 0.25
+        self.preannotation_nms_threshold = 0.45
+        self.preannotation_pending = 0
+        self.preannotation_cache = None
+        self.preannotation_class_names = {}
+        self.preannotation_errors = []
+        # Near-duplicate groups: representative -> members, and member -> representative
+        self.duplicate_threshold = 6
+        self.duplicate_groups = {}
+        self.duplicate_of = {}
+        self.duplicate_pending = 0
+        self.duplicate_cache = None
+        # Prefetch of the next image (and boxes tracked into it) on a background thread
+        self.loaded_image_index = None
+        self._prefetch = None
+        self._prefetch_pool = None
+        self._current_gray = None
+        # Tiled export settings
+        self.tile_size = 1024
+        self.tile_overlap = 128
+        self.tile_min_visibility = 0.3
+        self.tile_export_pending = 0
+        # Whole-image decodes of a 20k x 20k image take over a gigabyte each, so few run at once
+        self.tile_full_decode_workers = 2
+        self._full_decode_pool = None
+        # Train/val/test split used by all exports
+        self.split_ratios = (0.8, 0.1, 0.1)
+        self.split_seed = 0
+        # Annotated images the last export plan left out as near-duplicates
+        self.export_excluded = 0
+        # Sharded export
+        self.shard_size_bytes = 1 << 30
+        self.shard_export_pending = 0
+        # Background work is polled from the Tk event loop
+        self._process_pool = None
+        self._background_jobs = []
+        self._polling_jobs = False
+        # Analysis jobs tied to the open folder, dropped when another folder is opened
+        self._folder_jobs = set()
 
         # Create main window
         self.root = tk.Tk()
@@ -65,6 +939,22 @@ class SimpleAnnotator:
         # Add Delete Selected Annotation button (disabled by default)
         self.delete_selected_btn = tk.Button(parent, text="Delete Selected Annotation", command=self.delete_selected_annotation, state=tk.DISABLED)
         self.delete_selected_btn.pack(fill=tk.X, padx=10, pady=5)
+        # --- Model pre-annotation ---
+        tk.Button(parent, text="Pre-annotate Folder", command=self.start_preannotation).pack(fill=tk.X, padx=10, pady=5)
+        self.accept_proposal_btn = tk.Button(parent, text="Accept Selected Proposal", command=self.accept_selected_proposal, state=tk.DISABLED)
+        self.accept_proposal_btn.pack(fill=tk.X, padx=10, pady=5)
+        proposal_frame = tk.Frame(parent)
+        proposal_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(proposal_frame, text="Accept All Proposals", command=self.accept_all_proposals).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(proposal_frame, text="Reject All Proposals", command=self.reject_all_proposals).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        # --- Near-duplicate detection ---
+        tk.Button(parent, text="Find Near-Duplicates", command=self.find_near_duplicates).pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(parent, text="Propagate to Duplicates", command=self.propagate_to_duplicates).pack(fill=tk.X, padx=10, pady=5)
+        self.skip_duplicates = tk.BooleanVar(value=True)
+        tk.Checkbutton(parent, text="Skip near-duplicates", variable=self.skip_duplicates).pack(anchor=tk.W, padx=10)
+        self.propagate_boxes = tk.BooleanVar(value=False)
+        tk.Checkbutton(parent, text="Propagate boxes from previous image", variable=self.propagate_boxes,
+                       command=self.schedule_prefetch).pack(anchor=tk.W, padx=10)
         tk.Label(parent, text="Current Class:").pack(anchor=tk.W, padx=10, pady=(10, 0))
         self.class_var = tk.StringVar(value=self.classes[self.current_class])
         self.class_dropdown = tk.OptionMenu(parent, self.class_var, *self.classes, command=self.change_class)
@@ -77,7 +967,17 @@ class SimpleAnnotator:
         mode_frame.pack(fill=tk.X, padx=10, pady=5)
         tk.Radiobutton(mode_frame, text="Rectangle", variable=self.annotation_mode, value="rectangle").pack(side=tk.LEFT)
         tk.Radiobutton(mode_frame, text="Circle", variable=self.annotation_mode, value="circle").pack(side=tk.LEFT)
+        tk.Radiobutton(mode_frame, text="Polygon", variable=self.annotation_mode, value="polygon").pack(side=tk.LEFT)
+        tk.Radiobutton(mode_frame, text="Rotated Box", variable=self.annotation_mode, value="rotated_box").pack(side=tk.LEFT)
         # --- End move ---
+        tk.Button(parent, text="Export YOLO", command=self.export_to_yolo).pack(fill=tk.X, padx=10, pady=5)
+        self.yolo_obb = tk.BooleanVar(value=False)
+        tk.Checkbutton(parent, text="YOLO oriented boxes (OBB)", variable=self.yolo_obb).pack(anchor=tk.W, padx=10)
+        tk.Button(parent, text="Export COCO", command=self.export_to_coco).pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(parent, text="Export Shards", command=self.export_to_shards).pack(fill=tk.X, padx=10, pady=5)
+        tk.Button(parent, text="Export Tiles", command=self.export_tiles).pack(fill=tk.X, padx=10, pady=5)
+        self.drop_empty_tiles = tk.BooleanVar(value=True)
+        tk.Checkbutton(parent, text="Drop empty tiles", variable=self.drop_empty_tiles).pack(anchor=tk.W, padx=10)
         tk.Label(parent, text="Status:").pack(anchor=tk.W, padx=10, pady=(10, 0))
         self.status_var = tk.StringVar(value="Ready")
         self.status_label = tk.Label(parent, textvariable=self.status_var, wraplength=280, anchor="w", justify="left", width=40)
@@ -105,6 +1005,9 @@ class SimpleAnnotator:
             for circle in self.circles:
                 if circle["class"] in class_counts:
                     class_counts[circle["class"]] += 1
+        for polygon in self.polygons:
+            if polygon["class"] in class_counts:
+                class_counts[polygon["class"]] += 1
         # --- Show legend with counts ---
         for idx, cls in enumerate(self.classes):
             color = self.class_colors.get(cls, self.neon_colors[idx % len(self.neon_colors)])
@@ -136,6 +1039,7 @@ class SimpleAnnotator:
 
     def save_and_quit(self):
         self.save_annotations()
+        self.shutdown_workers()
         self.root.destroy()
 
     def setup_image_canvas(self, parent):
@@ -189,6 +1093,10 @@ class SimpleAnnotator:
         elif self.annotation_mode.get() == "circle":
             self.drawing = True
             self.current_circle = [(int((event.x - self.offset_x) / self.scale_factor), int((event.y - self.offset_y) / self.scale_factor))]
+        elif self.annotation_mode.get() in ("polygon", "rotated_box"):
+            # Polygons are sketched as a freehand outline while the button is held
+            self.drawing = True
+            self.current_stroke = [(int((event.x - self.offset_x) / self.scale_factor), int((event.y - self.offset_y) / self.scale_factor))]
 
     def on_draw_move(self, event):
         if not self.drawing:
@@ -203,6 +1111,13 @@ class SimpleAnnotator:
             x2 = int((event.x - self.offset_x) / self.scale_factor)
             y2 = int((event.y - self.offset_y) / self.scale_factor)
             self.display_image(temp_circle=[(x1, y1), (x2, y2)])
+        elif self.annotation_mode.get() in ("polygon", "rotated_box"):
+            x = int((event.x - self.offset_x) / self.scale_factor)
+            y = int((event.y - self.offset_y) / self.scale_factor)
+            px, py = self.current_stroke[-1]
+            if abs(x - px) + abs(y - py) >= 2:
+                self.current_stroke.append((x, y))
+                self.display_image(temp_stroke=self.current_stroke)
 
     def on_draw_end(self, event):
         if not self.drawing:
@@ -218,6 +1133,7 @@ class SimpleAnnotator:
             })
             self.display_image()
             self.update_legend()  # <-- update counts
+            self.schedule_prefetch()
             self.status_var.set(f"Added box with class '{self.class_var.get()}'. Total: {len(self.boxes)} boxes.")
         elif self.annotation_mode.get() == "circle":
             x1, y1 = self.current_circle[0]
@@ -231,7 +1147,29 @@ class SimpleAnnotator:
             })
             self.display_image()
             self.update_legend()  # <-- update counts
+            self.schedule_prefetch()
             self.status_var.set(f"Added circle with class '{self.class_var.get()}'. Total: {len(self.circles)} circles.")
+        elif self.annotation_mode.get() in ("polygon", "rotated_box"):
+            stroke = self.current_stroke
+            self.current_stroke = []
+            if len(stroke) < 3:
+                self.display_image()
+                return
+            kind = self.annotation_mode.get()
+            if kind == "polygon":
+                points = simplify_polygon(stroke, self.max_polygon_points)
+            else:
+                points = rotated_box_points(stroke)
+            if len(points) < 3:
+                self.display_image()
+                return
+            self.polygons.append(make_polygon(kind, points, self.class_var.get()))
+            self.display_image()
+            self.update_legend()  # <-- update counts
+            self.schedule_prefetch()
+            label = "polygon" if kind == "polygon" else "rotated box"
+            self.status_var.set(f"Added {label} with class '{self.class_var.get()}' ({len(points)} points). "
+                                f"Total: {len(self.polygons)} polygons/rotated boxes.")
 
     # --- Circle annotation handlers ---
     def on_circle_start(self, event):
@@ -261,10 +1199,11 @@ class SimpleAnnotator:
         })
         self.display_image()
         self.update_legend()  # <-- update counts
+        self.schedule_prefetch()
         self.status_var.set(f"Added circle with class '{self.class_var.get()}'. Total: {len(self.circles)} circles.")
 
     # Update display_image to render circles
-    def display_image(self, temp_box=None, temp_circle=None):
+    def display_image(self, temp_box=None, temp_circle=None, temp_stroke=None):
         if self.resized_img is None:
             return
         self.tk_img = ImageTk.PhotoImage(self.resized_img)
@@ -301,6 +1240,31 @@ class SimpleAnnotator:
                                            outline=color, width=2, fill=fill_color, stipple="gray25")
                 else:
                     self.canvas.create_oval(x1_disp - r, y1_disp - r, x1_disp + r, y1_disp + r, outline=color, width=2)
+        # Draw polygons and rotated boxes
+        for idx, polygon in enumerate(self.polygons):
+            color = self.get_class_color(polygon["class"])
+            coords = []
+            for x, y in polygon["polygon"]:
+                coords += [int(x * self.scale_factor) + self.offset_x, int(y * self.scale_factor) + self.offset_y]
+            if getattr(self, "selected_annotation", None) == ("polygon", idx):
+                self.canvas.create_polygon(coords, outline=color, width=2, fill=color, stipple="gray25")
+            else:
+                self.canvas.create_polygon(coords, outline=color, width=2, fill="")
+        # Draw pending model proposals (dashed, with score)
+        for idx, proposal in enumerate(self.current_proposals()):
+            (x1, y1), (x2, y2) = proposal["box"]
+            color = self.get_class_color(proposal["class"])
+            x1_disp = int(x1 * self.scale_factor) + self.offset_x
+            y1_disp = int(y1 * self.scale_factor) + self.offset_y
+            x2_disp = int(x2 * self.scale_factor) + self.offset_x
+            y2_disp = int(y2 * self.scale_factor) + self.offset_y
+            if getattr(self, "selected_annotation", None) == ("proposal", idx):
+                self.canvas.create_rectangle(x1_disp, y1_disp, x2_disp, y2_disp, outline=color, width=1, dash=(6, 4),
+                                             fill=color, stipple="gray25")
+            else:
+                self.canvas.create_rectangle(x1_disp, y1_disp, x2_disp, y2_disp, outline=color, width=1, dash=(6, 4))
+            self.canvas.create_text(x1_disp + 2, y1_disp - 2, anchor=tk.SW, fill=color,
+                                    text=f"{proposal['class']} {proposal['score']:.2f}")
         # Draw temp box
         if temp_box:
             (x1, y1), (x2, y2) = temp_box
@@ -320,17 +1284,33 @@ class SimpleAnnotator:
             y2_disp = int(y2 * self.scale_factor) + self.offset_y
             r = int(((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5 * self.scale_factor)
             self.canvas.create_oval(x1_disp - r, y1_disp - r, x1_disp + r, y1_disp + r, outline=color, width=2, dash=(4, 2))
+        # Draw the outline being sketched
+        if temp_stroke and len(temp_stroke) > 1:
+            color = self.get_class_color(self.class_var.get())
+            coords = []
+            for x, y in temp_stroke:
+                coords += [int(x * self.scale_factor) + self.offset_x, int(y * self.scale_factor) + self.offset_y]
+            self.canvas.create_line(coords, fill=color, width=2, dash=(4, 2))
 
     def select_folder(self):
         folder_path = filedialog.askdirectory(title="Select folder with images")
         if not folder_path:
             return False
+        self.cancel_folder_jobs()
         self.folder_path = folder_path
-        self.image_files = [f for f in os.listdir(folder_path)
-                            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))]
+        self.proposals = {}
+        self.duplicate_groups = {}
+        self.duplicate_of = {}
+        self.loaded_image_index = None
+        self._prefetch = None
+        # Sorted so frame dumps are walked in sequence order
+        self.image_files = sorted((f for f in os.listdir(folder_path)
+                                   if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff'))),
+                                  key=natural_sort_key)
         if not self.image_files:
             self.status_var.set("No image files found in the selected folder")
             return False
+        self.update_duplicate_groups()
         self.current_image_index = 0
         self.load_current_image()
         return True
@@ -343,8 +1323,14 @@ class SimpleAnnotator:
         if not image_path:
             return False
 
+        self.cancel_folder_jobs()
         self.folder_path = os.path.dirname(image_path)
         self.image_path = image_path
+        self.proposals = {}
+        self.duplicate_groups = {}
+        self.duplicate_of = {}
+        self.loaded_image_index = None
+        self._prefetch = None
         self.image_files = [os.path.basename(image_path)]
         self.current_image_index = 0
         self.load_current_image()
@@ -355,13 +1341,23 @@ class SimpleAnnotator:
             self.status_var.set("No image to load")
             return False
 
+        # Keep the previous image's annotations around for propagation
+        previous = (self.loaded_image_index, self.original_image, self._current_gray, self.boxes,
+                    getattr(self, "circles", []), self.polygons)
+
         # Clear previous annotations
         self.boxes = []
 
-        # Load current image
+        # Load current image, reusing the prefetched decode when there is one
         current_file = self.image_files[self.current_image_index]
         self.image_path = os.path.join(self.folder_path, current_file)
-        self.original_image = cv2.imread(self.image_path)
+        if self._prefetch and self._prefetch["path"] == self.image_path:
+            self.original_image, gray = self._prefetch["image"].result()
+            self._current_gray = Future()
+            self._current_gray.set_result(gray)
+        else:
+            self.original_image = cv2.imread(self.image_path)
+            self._current_gray = None
 
         if self.original_image is None:
             self.status_var.set("Failed to load image")
@@ -389,21 +1385,85 @@ class SimpleAnnotator:
         self.display_image()
 
         # Try to load existing annotations if they exist
-        self.load_annotations()
+        has_saved = self.load_annotations()
+        prev_index, prev_image, prev_gray, prev_boxes, prev_circles, prev_polygons = previous
+        if (not has_saved and self.propagate_boxes.get() and prev_image is not None
+                and prev_index is not None and self.current_image_index > prev_index):
+            self.boxes, self.circles, self.polygons = self.propagated_annotations(
+                prev_image, prev_gray, prev_boxes, prev_circles, prev_polygons)
+            self.update_legend()
+            self.status_var.set(f"Propagated {len(self.boxes)} boxes, {len(self.circles)} circles and "
+                                f"{len(self.polygons)} polygons from previous image")
         self.display_image()  # <-- Ensure annotations are shown after loading
+        self.loaded_image_index = self.current_image_index
 
         # Reset pan offset so annotations are visible
         self.offset_x = 0
         self.offset_y = 0
 
+        self.schedule_prefetch()
         return True
 
+    def annotation_key(self, boxes, circles, polygons):
+        return json.dumps([[b["box"], b["class"]] for b in boxes] + [[c["circle"], c["class"]] for c in circles]
+                          + [[p["polygon"], p["class"]] for p in polygons])
+
+    def propagated_annotations(self, prev_image, prev_gray, prev_boxes, prev_circles, prev_polygons):
+        # Use the result tracked during prefetch when it was computed from the same annotations
+        prefetch = self._prefetch
+        if (prefetch and prefetch["path"] == self.image_path and prefetch["track"] is not None
+                and prefetch["key"] == self.annotation_key(prev_boxes, prev_circles, prev_polygons)):
+            return prefetch["track"].result()
+        prev_gray = prev_gray.result() if prev_gray is not None else cv2.cvtColor(prev_image, cv2.COLOR_BGR2GRAY)
+        next_gray = self.current_gray_future().result()
+        return propagate_annotations(prev_gray, next_gray, prev_boxes, prev_circles, prev_polygons)
+
+    def current_gray_future(self):
+        if self._prefetch_pool is None:
+            self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        if self._current_gray is None:
+            self._current_gray = self._prefetch_pool.submit(cv2.cvtColor, self.original_image, cv2.COLOR_BGR2GRAY)
+        return self._current_gray
+
+    def schedule_prefetch(self):
+        if not self.image_files or self.original_image is None:
+            return
+        index = self.step_index(1)
+        if index is None:
+            self._prefetch = None
+            return
+        path = os.path.join(self.folder_path, self.image_files[index])
+        if self._prefetch_pool is None:
+            self._prefetch_pool = ThreadPoolExecutor(max_workers=1)
+        if not self._prefetch or self._prefetch["path"] != path:
+            if self._prefetch:
+                self._prefetch["image"].cancel()
+                if self._prefetch["track"] is not None:
+                    self._prefetch["track"].cancel()
+            self._prefetch = {"path": path, "image": self._prefetch_pool.submit(decode_frame, path),
+                              "key": None, "track": None}
+        if not self.propagate_boxes.get():
+            return
+        circles = getattr(self, "circles", [])
+        key = self.annotation_key(self.boxes, circles, self.polygons)
+        if key != self._prefetch["key"]:
+            # Only the latest annotations matter: drop a queued job for an older edit so Next never
+            # waits behind it
+            if self._prefetch["track"] is not None:
+                self._prefetch["track"].cancel()
+            # Snapshot the lists so later edits don't race with the tracker
+            self._prefetch["key"] = key
+            self._prefetch["track"] = self._prefetch_pool.submit(
+                _track_prefetched, self.current_gray_future(), self._prefetch["image"], list(self.boxes),
+                list(circles), list(self.polygons))
+
     def load_annotations(self):
-        annotation_path = os.path.join(self.folder_path, "all_annotations.json")
+        annotation_path = os.path.join(self.folder_path, ANNOTATION_FILE)
         self.boxes = []
         self.circles = []
+        self.polygons = []
         if not os.path.exists(annotation_path):
-            return
+            return False
         try:
             with open(annotation_path, 'r') as f:
                 data = json.load(f)
@@ -413,6 +1473,13 @@ class SimpleAnnotator:
                 self.update_class_dropdown()
             if "colors" in data:
                 self.class_colors = data["colors"]
+            # Pending proposals already in memory are authoritative (they may have been accepted/rejected)
+            for name, proposals in data.get("proposals", {}).items():
+                self.proposals.setdefault(name, [{
+                    "box": [(p["box"][0], p["box"][1]), (p["box"][2], p["box"][3])],
+                    "class": p["class"],
+                    "score": p["score"]
+                } for p in proposals])
             # Load current image annotations
             img_name = os.path.basename(self.image_path)
             img_ann = data.get("images", {}).get(img_name, {})
@@ -430,18 +1497,24 @@ class SimpleAnnotator:
                         "circle": [(x1, y1), (x2, y2)],
                         "class": cls
                     })
+                for kind, key in (("polygon", "polygons"), ("rotated_box", "rotated_boxes")):
+                    for flat in ann.get(key, []):
+                        self.polygons.append(make_polygon(kind, list(zip(flat[0::2], flat[1::2])), cls))
             self.status_var.set(f"Loaded annotations for {img_name}")
             self.update_legend()  # <-- update counts
+            return img_name in data.get("images", {})
         except Exception as e:
             self.status_var.set(f"Error loading annotations: {e}")
+            return False
 
     def next_image(self):
         if not self.image_files:
             return
 
         self.save_annotations()  # Save before switching
-        if self.current_image_index < len(self.image_files) - 1:
-            self.current_image_index += 1
+        index = self.step_index(1)
+        if index is not None:
+            self.current_image_index = index
             self.load_current_image()
         else:
             self.status_var.set("Already at the last image")
@@ -451,12 +1524,22 @@ class SimpleAnnotator:
             return
 
         self.save_annotations()  # Save before switching
-        if self.current_image_index > 0:
-            self.current_image_index -= 1
+        index = self.step_index(-1)
+        if index is not None:
+            self.current_image_index = index
             self.load_current_image()
         else:
             self.status_var.set("Already at the first image")
 
+    def step_index(self, direction):
+        # Next/previous image index, skipping near-duplicates of an already shown representative
+        index = self.current_image_index + direction
+        while 0 <= index < len(self.image_files):
+            if not (self.skip_duplicates.get() and self.image_files[index] in self.duplicate_of):
+                return index
+            index += direction
+        return None
+
     def update_class_dropdown(self):
         menu = self.class_dropdown["menu"]
         menu.delete(0, "end")
@@ -487,10 +1570,17 @@ class SimpleAnnotator:
             del self.boxes[idx]
         elif typ == "circle" and hasattr(self, "circles"):
             del self.circles[idx]
+        elif typ == "polygon":
+            del self.polygons[idx]
+        elif typ == "proposal":
+            # Deleting a proposal rejects it
+            del self.current_proposals()[idx]
         self.selected_annotation = None
         self.delete_selected_btn.config(state=tk.DISABLED)
+        self.accept_proposal_btn.config(state=tk.DISABLED)
         self.display_image()
         self.update_legend()  # <-- update counts
+        self.schedule_prefetch()
         self.status_var.set("Annotation deleted.")
 
     def mouse_callback(self, event, x, y, flags, param):
@@ -531,7 +1621,7 @@ class SimpleAnnotator:
         pass
 
     def save_annotations(self):
-        annotation_path = os.path.join(self.folder_path, "all_annotations.json")
+        annotation_path = os.path.join(self.folder_path, ANNOTATION_FILE)
         data = {}
         if os.path.exists(annotation_path):
             try:
@@ -546,7 +1636,7 @@ class SimpleAnnotator:
         img_name = os.path.basename(self.image_path)
         img_ann = {}
         for cls in self.classes:
-            img_ann[cls] = {"boxes": [], "circles": []}
+            img_ann[cls] = {"boxes": [], "circles": [], "polygons": [], "rotated_boxes": []}
         for box in self.boxes:
             cls = box["class"]
             # Save coordinates in original image space
@@ -565,11 +1655,48 @@ class SimpleAnnotator:
                     int(circle["circle"][1][0]),
                     int(circle["circle"][1][1])
                 ])
+        for polygon in self.polygons:
+            key = "polygons" if polygon["kind"] == "polygon" else "rotated_boxes"
+            # Flat [x1, y1, x2, y2, ...] like COCO segmentation
+            img_ann[polygon["class"]][key].append([int(v) for point in polygon["polygon"] for v in point])
         data["images"][img_name] = img_ann
+        data["proposals"] = {
+            name: [{
+                "box": [int(p["box"][0][0]), int(p["box"][0][1]), int(p["box"][1][0]), int(p["box"][1][1])],
+                "class": p["class"],
+                "score": p["score"]
+            } for p in proposals]
+            for name, proposals in self.proposals.items()
+        }
         with open(annotation_path, 'w') as f:
             json.dump(data, f, indent=2)
         self.status_var.set(f"Saved annotations for {img_name} to {annotation_path}")
 
+    def plan_export(self):
+        # One pass over the annotation index: boxes per image, then a stratified split assignment
+        if self.image_path:
+            self.save_annotations()
+        self.update_duplicate_groups()
+        images = read_annotation_index(self.folder_path).get("images", {})
+        # Near-duplicates are left out only while they are being skipped; frames the user chose to
+        # annotate individually (or filled via "Propagate to Duplicates") are exported like any other
+        skip = self.skip_duplicates.get()
+        annotated = [img_file for img_file in self.image_files if img_file in images]
+        self.export_excluded = sum(1 for img_file in annotated if skip and img_file in self.duplicate_of)
+        shapes = {img_file: (annotation_rects(images[img_file], self.classes),
+                             annotation_polygons(images[img_file], self.classes))
+                  for img_file in annotated
+                  if not (skip and img_file in self.duplicate_of)}
+        splits = assign_splits({name: {r[0] for r in rects} | {p[0] for p in polygons}
+                                for name, (rects, polygons) in shapes.items()},
+                               self.split_ratios, self.split_seed)
+        return [(img_file, shapes[img_file][0], shapes[img_file][1], splits[img_file])
+                for img_file in self.image_files if img_file in shapes]
+
+    def excluded_note(self, excluded=None):
+        excluded = self.export_excluded if excluded is None else excluded
+        return f" ({excluded} near-duplicates excluded)" if excluded else ""
+
     def export_to_yolo(self):
         if not self.folder_path:
             self.status_var.set("No folder selected")
@@ -584,171 +1711,586 @@ class SimpleAnnotator:
         with open(classes_file, 'w') as f:
             f.write("\n".join(self.classes))
 
-        # Create directories
-        images_dir = os.path.join(output_dir, "images")
-        labels_dir = os.path.join(output_dir, "labels")
-        os.makedirs(images_dir, exist_ok=True)
-        os.makedirs(labels_dir, exist_ok=True)
+        # Create one empty images/labels directory per split
+        for split in SPLITS:
+            reset_dirs(os.path.join(output_dir, "images", split), os.path.join(output_dir, "labels", split))
 
-        # Import shutil once
-        import shutil
 
         # Process all images
         count = 0
-        for img_file in self.image_files:
+        obb = self.yolo_obb.get()
+        for img_file, rects, polygons, split in self.plan_export():
             base_name = os.path.splitext(img_file)[0]
-            json_path = os.path.join(self.folder_path, f"{base_name}_annotations.json")
-
-            if not os.path.exists(json_path):
-                continue
-
-            # Copy the image file
             src_img = os.path.join(self.folder_path, img_file)
-            dst_img = os.path.join(images_dir, img_file)
-            if os.path.exists(src_img):
-                shutil.copy2(src_img, dst_img)
-
-            # Read image dimensions
-            img = cv2.imread(src_img)
-            if img is None:
-                continue
-
-            img_h, img_w = img.shape[:2]
-
-            # Create YOLO annotation
-            yolo_file = os.path.join(labels_dir, f"{base_name}.txt")
-
             try:
-                with open(json_path, 'r') as f:
-                    data = json.load(f)
-
-                if "boxes" not in data:
-                    continue
-
-                with open(yolo_file, 'w') as f:
-                    for box in data["boxes"]:
-                        if "class" not in box or not all(k in box for k in ["x1", "y1", "x2", "y2"]):
-                            continue
-
-                        class_id = self.classes.index(box["class"])
-                        x1, y1, x2, y2 = box["x1"], box["y1"], box["x2"], box["y2"]
-
-                        # Normalize coordinates (YOLO format)
-                        x_center = ((x1 + x2) / 2) / img_w
-                        y_center = ((y1 + y2) / 2) / img_h
-                        width = (x2 - x1) / img_w
-                        height = (y2 - y1) / img_h
-
-                        f.write(f"{class_id} {x_center} {y_center} {width} {height}\n")
+                # Only the header is read for the dimensions
+                img_w, img_h = image_size(src_img)
+                shutil.copy2(src_img, os.path.join(output_dir, "images", split, img_file))
+                with open(os.path.join(output_dir, "labels", split, f"{base_name}.txt"), 'w') as f:
+                    if obb:
+                        f.write(yolo_obb_label_text(rects, polygons, img_w, img_h))
+                    else:
+                        # Plain detection labels: polygons and rotated boxes become their bounding box
+                        f.write(yolo_label_text(rects + polygon_rects(clip_polygons(polygons, img_w, img_h)),
+                                                img_w, img_h))
                 count += 1
             except Exception as e:
-                self.status_var.set(f"Error processing {json_path}: {e}")
+                self.status_var.set(f"Error processing {img_file}: {e}")
                 continue
 
         # Create dataset.yaml for easy use with YOLOv5/v8
-        yaml_path = os.path.join(output_dir, "dataset.yaml")
-        with open(yaml_path, 'w') as f:
-            f.write(f"path: {output_dir}\n")
-            f.write("train: images\n")
-            f.write("val: images\n\n")
-            f.write(f"nc: {len(self.classes)}\n")
-            f.write(f"names: {self.classes}\n")
+        write_dataset_yaml(output_dir, self.classes)
 
-        self.status_var.set(f"Exported {count} annotations to YOLO format in {output_dir}")
+        self.status_var.set(f"Exported {count} annotations to YOLO format in {output_dir}{self.excluded_note()}")
 
     def export_to_coco(self):
         if not self.folder_path:
             self.status_var.set("No folder selected")
             return
 
-        # Create output directory
+        # Create output directory, one sub-folder with images and annotations.json per split
         output_dir = os.path.join(self.folder_path, "coco_export")
-        os.makedirs(output_dir, exist_ok=True)
-        output_file = os.path.join(output_dir, "annotations.json")
+        categories = [{"id": idx + 1, "name": class_name, "supercategory": "none"}
+                      for idx, class_name in enumerate(self.classes)]
+        coco_splits = {split: {"images": [], "annotations": [], "categories": categories} for split in SPLITS}
+        for split in SPLITS:
+            reset_dirs(os.path.join(output_dir, split))
 
-        coco_data = {
-            "images": [],
-            "annotations": [],
-            "categories": []
-        }
-
-        # Create categories
-        for idx, class_name in enumerate(self.classes):
-            coco_data["categories"].append({
-                "id": idx + 1,
-                "name": class_name,
-                "supercategory": "none"
-            })
-
-        # Import shutil once
-        import shutil
 
         # Process all images
         annotation_id = 1
-        for img_id, img_file in enumerate(self.image_files):
-            base_name = os.path.splitext(img_file)[0]
-            json_path = os.path.join(self.folder_path, f"{base_name}_annotations.json")
-
-            if not os.path.exists(json_path):
-                continue
-
-            # Copy the image file to output directory
+        for img_id, (img_file, rects, polygons, split) in enumerate(self.plan_export(), start=1):
             src_img = os.path.join(self.folder_path, img_file)
-            dst_img = os.path.join(output_dir, img_file)
-            if os.path.exists(src_img):
-                shutil.copy2(src_img, dst_img)
-
-            # Read image dimensions
-            img = cv2.imread(src_img)
-            if img is None:
+            try:
+                w, h = image_size(src_img)
+                shutil.copy2(src_img, os.path.join(output_dir, split, img_file))
+            except Exception as e:
+                self.status_var.set(f"Error processing {img_file}: {e}")
                 continue
-
-            h, w = img.shape[:2]
+            coco_data = coco_splits[split]
 
             # Add image to COCO format
             coco_data["images"].append({
-                "id": img_id + 1,
+                "id": img_id,
                 "width": w,
                 "height": h,
                 "file_name": img_file
             })
+            for class_id, x1, y1, x2, y2 in clip_rects(rects, 0, 0, w, h):
+                width = x2 - x1
+                height = y2 - y1
+                coco_data["annotations"].append({
+                    "id": annotation_id,
+                    "image_id": img_id,
+                    "category_id": class_id + 1,
+                    "bbox": [x1, y1, width, height],
+                    "area": width * height,
+                    "segmentation": [],
+                    "iscrowd": 0
+                })
+                annotation_id += 1
+            # Segmentation, bbox and area all come from the shape clipped to the image
+            for class_id, _, points in clip_polygons(polygons, w, h):
+                x1, y1, x2, y2 = polygon_bbox(points)
+                coco_data["annotations"].append({
+                    "id": annotation_id,
+                    "image_id": img_id,
+                    "category_id": class_id + 1,
+                    "bbox": [x1, y1, x2 - x1, y2 - y1],
+                    "area": polygon_area(points),
+                    "segmentation": [[v for point in points for v in point]],
+                    "iscrowd": 0
+                })
+                annotation_id += 1
+
+        for split, coco_data in coco_splits.items():
+            with open(os.path.join(output_dir, split, "annotations.json"), 'w') as f:
+                json.dump(coco_data, f, indent=2)
+
+        self.status_var.set(f"Exported annotations to COCO format in {output_dir}{self.excluded_note()}")
+
+    # --- Model pre-annotation ---
+    def current_proposals(self):
+        if not self.image_path:
+            return []
+        return self.proposals.get(os.path.basename(self.image_path), [])
+
+    def ensure_class(self, cls):
+        if cls not in self.classes:
+            self.classes.append(cls)
+            self.class_colors.setdefault(cls, self.neon_colors[(len(self.classes) - 1) % len(self.neon_colors)])
+            self.update_class_dropdown()
+
+    def accept_selected_proposal(self):
+        if not self.selected_annotation or self.selected_annotation[0] != "proposal":
+            return
+        proposal = self.current_proposals().pop(self.selected_annotation[1])
+        self.ensure_class(proposal["class"])
+        self.boxes.append({"box": proposal["box"], "class": proposal["class"]})
+        self.selected_annotation = None
+        self.delete_selected_btn.config(state=tk.DISABLED)
+        self.accept_proposal_btn.config(state=tk.DISABLED)
+        self.display_image()
+        self.update_legend()  # <-- update counts
+        self.schedule_prefetch()
+        self.status_var.set(f"Accepted proposal as '{proposal['class']}'. Total: {len(self.boxes)} boxes.")
+
+    def accept_all_proposals(self):
+        proposals = self.current_proposals()
+        if not proposals:
+            self.status_var.set("No proposals for this image")
+            return
+        for proposal in proposals:
+            self.ensure_class(proposal["class"])
+            self.boxes.append({"box": proposal["box"], "class": proposal["class"]})
+        count = len(proposals)
+        proposals.clear()
+        self.selected_annotation = None
+        self.display_image()
+        self.update_legend()  # <-- update counts
+        self.schedule_prefetch()
+        self.status_var.set(f"Accepted {count} proposals. Total: {len(self.boxes)} boxes.")
+
+    def reject_all_proposals(self):
+        proposals = self.current_proposals()
+        count = len(proposals)
+        proposals.clear()
+        self.selected_annotation = None
+        self.display_image()
+        self.status_var.set(f"Rejected {count} proposals.")
+
+    def start_preannotation(self):
+        if not self.folder_path or not self.image_files:
+            self.status_var.set("No folder selected")
+            return
+        if self.preannotation_pending:
+            self.status_var.set("Pre-annotation already running")
+            return
+        model_path = filedialog.askopenfilename(
+            title="Select detector model",
+            filetypes=[("ONNX detector (YOLOv8 layout)", "*.onnx"), ("All files", "*.*")]
+        )
+        if not model_path:
+            return
+        self.preannotation_model = model_path
+        self.preannotation_class_names = read_model_class_names(model_path)
+        self.preannotation_cache = self.load_preannotation_cache(model_path)
+        self.preannotation_errors = []
+        # Files whose size/mtime are unchanged are served straight from the cache, without re-hashing
+        to_hash = []
+        cached = 0
+        for img_file in self.image_files:
+            path = os.path.join(self.folder_path, img_file)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = self.preannotation_cache["files"].get(img_file)
+            if entry and entry[:2] == [st.st_size, st.st_mtime_ns] and entry[2] in self.preannotation_cache["results"]:
+                self.seed_proposals(img_file, self.preannotation_cache["results"][entry[2]])
+                cached += 1
+            else:
+                to_hash.append(path)
+        if not to_hash:
+            self.display_image()
+            self.status_var.set(f"Pre-annotation loaded from cache for {cached} images")
+            return
+        # Changed files are hashed first; only digests missing from the cache go on to inference
+        batch = 64
+        for start in range(0, len(to_hash), batch):
+            self.submit_preannotation_job(self.on_preannotation_hashes, _hash_files, to_hash[start:start + batch])
+        self.status_var.set(f"Pre-annotating {len(to_hash)} images ({cached} cached)...")
+
+    def submit_preannotation_job(self, callback, fn, *args):
+        future = self.get_process_pool().submit(fn, *args)
+        self.preannotation_pending += 1
+        self._folder_jobs.add(future)
+        self.watch_future(future, callback)
+
+    def on_preannotation_hashes(self, future):
+        self._folder_jobs.discard(future)
+        self.preannotation_pending -= 1
+        try:
+            hashed = future.result()
+        except Exception as e:
+            self.preannotation_errors.append(str(e))
+            hashed = []
+        results = self.preannotation_cache["results"]
+        misses = []
+        for path, digest in hashed:
+            if digest in results:
+                self.record_preannotation(path, digest, results[digest])
+            else:
+                misses.append((path, digest))
+        size = self.preannotation_batch_size
+        for start in range(0, len(misses), size):
+            self.submit_preannotation_job(self.on_preannotation_batch, _preannotate_batch, self.preannotation_model,
+                                          misses[start:start + size], self.preannotation_input_size,
+                                          self.preannotation_conf_threshold, self.preannotation_nms_threshold,
+                                          len(self.preannotation_class_names) or None)
+        self.finish_preannotation_step()
+
+    def on_preannotation_batch(self, future):
+        self._folder_jobs.discard(future)
+        self.preannotation_pending -= 1
+        try:
+            results = future.result()
+        except Exception as e:
+            self.preannotation_errors.append(str(e))
+            results = []
+        for path, digest, detections in results:
+            self.preannotation_cache["results"][digest] = detections
+            self.record_preannotation(path, digest, detections)
+        self.finish_preannotation_step()
+
+    def record_preannotation(self, path, digest, detections):
+        img_file = os.path.basename(path)
+        try:
+            st = os.stat(path)
+            self.preannotation_cache["files"][img_file] = [st.st_size, st.st_mtime_ns, digest]
+        except OSError:
+            pass
+        self.seed_proposals(img_file, detections)
+        if self.image_path and img_file == os.path.basename(self.image_path):
+            self.display_image()
+
+    def finish_preannotation_step(self):
+        if self.preannotation_pending:
+            self.status_var.set(f"Pre-annotating... {self.preannotation_pending} batches left")
+            return
+        self.save_preannotation_cache()
+        if self.preannotation_errors:
+            self.status_var.set(f"Pre-annotation finished with {len(self.preannotation_errors)} failed batches: "
+                                f"{self.preannotation_errors[0]}")
+        else:
+            self.status_var.set("Pre-annotation finished")
 
+    def seed_proposals(self, img_file, detections):
+        # Only seed images that have never had proposals, so accept/reject decisions survive a re-run
+        if img_file in self.proposals:
+            return
+        proposals = []
+        for det in detections:
+            class_id = det["class_id"]
+            cls = self.preannotation_class_names.get(class_id, f"class_{class_id}")
+            x1, y1, x2, y2 = det["box"]
+            proposals.append({"box": [(x1, y1), (x2, y2)], "class": cls, "score": det["score"]})
+        self.proposals[img_file] = proposals
+
+    def preannotation_signature(self, model_path):
+        st = os.stat(model_path)
+        return (f"{os.path.abspath(model_path)}:{st.st_size}:{st.st_mtime_ns}:{self.preannotation_input_size}:"
+                f"{self.preannotation_conf_threshold}:{self.preannotation_nms_threshold}")
+
+    def load_preannotation_cache(self, model_path):
+        signature = self.preannotation_signature(model_path)
+        cache_path = os.path.join(self.folder_path, PREANNOTATION_CACHE_FILE)
+        if os.path.exists(cache_path):
             try:
-                with open(json_path, 'r') as f:
+                with open(cache_path, 'r') as f:
                     data = json.load(f)
+                if data.get("model") == signature:
+                    return data
+            except Exception:
+                pass
+        return {"model": signature, "files": {}, "results": {}}
 
-                if "boxes" not in data:
-                    continue
+    def save_preannotation_cache(self):
+        cache_path = os.path.join(self.folder_path, PREANNOTATION_CACHE_FILE)
+        with open(cache_path, 'w') as f:
+            json.dump(self.preannotation_cache, f)
 
-                for box in data["boxes"]:
-                    if "class" not in box or not all(k in box for k in ["x1", "y1", "x2", "y2"]):
-                        continue
+    # --- Near-duplicate detection ---
+    def find_near_duplicates(self):
+        if not self.folder_path or not self.image_files:
+            self.status_var.set("No folder selected")
+            return
+        if self.duplicate_pending:
+            self.status_var.set("Near-duplicate search already running")
+            return
+        self.duplicate_cache = self.load_image_hash_cache()
+        files = self.duplicate_cache["files"]
+        to_hash = []
+        for img_file in self.image_files:
+            path = os.path.join(self.folder_path, img_file)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = files.get(img_file)
+            if not entry or entry[:2] != [st.st_size, st.st_mtime_ns]:
+                to_hash.append(path)
+        if not to_hash:
+            self.finish_near_duplicates()
+            return
+        pool = self.get_process_pool()
+        batch = 64
+        for start in range(0, len(to_hash), batch):
+            future = pool.submit(_hash_image_batch, to_hash[start:start + batch])
+            self.duplicate_pending += 1
+            self._folder_jobs.add(future)
+            self.watch_future(future, self.on_hash_batch)
+        self.status_var.set(f"Hashing {len(to_hash)} images...")
+
+    def on_hash_batch(self, future):
+        self._folder_jobs.discard(future)
+        self.duplicate_pending -= 1
+        try:
+            results = future.result()
+        except Exception as e:
+            self.status_var.set(f"Hashing failed: {e}")
+            results = []
+        for path, d, p in results:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self.duplicate_cache["files"][os.path.basename(path)] = [st.st_size, st.st_mtime_ns, f"{d:016x}", f"{p:016x}"]
+        if self.duplicate_pending == 0:
+            self.save_image_hash_cache()
+            self.finish_near_duplicates()
+        else:
+            self.status_var.set(f"Hashing... {self.duplicate_pending} batches left")
+
+    def finish_near_duplicates(self):
+        self.update_duplicate_groups(self.duplicate_cache)
+        self.status_var.set(f"Found {len(self.duplicate_groups)} near-duplicate groups "
+                            f"({len(self.duplicate_of)} redundant images)")
+
+    def update_duplicate_groups(self, cache=None):
+        # Groups are rebuilt from the saved hash cache (entries whose size/mtime still match), so
+        # navigation and exports don't depend on "Find Near-Duplicates" having run this session
+        files = (cache or self.load_image_hash_cache())["files"]
+        hashes = []
+        for img_file in self.image_files:
+            entry = files.get(img_file)
+            if not entry:
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder_path, img_file))
+            except OSError:
+                continue
+            if entry[:2] == [st.st_size, st.st_mtime_ns]:
+                hashes.append((img_file, int(entry[2], 16), int(entry[3], 16)))
+        self.duplicate_groups = group_near_duplicates(hashes, self.duplicate_threshold)
+        self.duplicate_of = {m: rep for rep, members in self.duplicate_groups.items() for m in members if m != rep}
 
-                    x1, y1, x2, y2 = box["x1"], box["y1"], box["x2"], box["y2"]
-                    width = x2 - x1
-                    height = y2 - y1
+    def propagate_to_duplicates(self):
+        if not self.image_path:
+            return
+        img_name = os.path.basename(self.image_path)
+        rep = self.duplicate_of.get(img_name, img_name)
+        members = [m for m in self.duplicate_groups.get(rep, []) if m != img_name]
+        if not members:
+            self.status_var.set("Current image has no near-duplicates")
+            return
+        self.save_annotations()
+        annotation_path = os.path.join(self.folder_path, ANNOTATION_FILE)
+        with open(annotation_path, 'r') as f:
+            data = json.load(f)
+        for member in members:
+            data["images"][member] = json.loads(json.dumps(data["images"][img_name]))
+        with open(annotation_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        self.status_var.set(f"Copied annotations of {img_name} to {len(members)} near-duplicates")
+
+    def load_image_hash_cache(self):
+        cache_path = os.path.join(self.folder_path, IMAGE_HASH_CACHE_FILE)
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    return json.load(f)
+            except Exception:
+                pass
+        return {"files": {}}
+
+    def save_image_hash_cache(self):
+        cache_path = os.path.join(self.folder_path, IMAGE_HASH_CACHE_FILE)
+        with open(cache_path, 'w') as f:
+            json.dump(self.duplicate_cache, f)
+
+    # --- Background work ---
+    def get_process_pool(self):
+        if self._process_pool is None:
+            # Never fork the Tk process (it has live threads), start workers fresh instead
+            self._process_pool = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1),
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        return self._process_pool
+
+    def get_full_decode_pool(self):
+        if self._full_decode_pool is None:
+            self._full_decode_pool = ProcessPoolExecutor(max_workers=self.tile_full_decode_workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+        return self._full_decode_pool
+
+    def watch_future(self, future, callback):
+        self._background_jobs.append((future, callback))
+        if not self._polling_jobs:
+            self._polling_jobs = True
+            self.root.after(100, self.poll_background_jobs)
+
+    def poll_background_jobs(self):
+        done = [job for job in self._background_jobs if job[0].done()]
+        self._background_jobs = [job for job in self._background_jobs if not job[0].done()]
+        for future, callback in done:
+            callback(future)
+        if self._background_jobs:
+            self.root.after(100, self.poll_background_jobs)
+        else:
+            self._polling_jobs = False
+
+    def cancel_folder_jobs(self):
+        # Results belong to the folder the job was started on; never apply them to a newly opened one
+        for future in self._folder_jobs:
+            future.cancel()
+        self._background_jobs = [job for job in self._background_jobs if job[0] not in self._folder_jobs]
+        self._folder_jobs = set()
+        self.preannotation_pending = 0
+        self.duplicate_pending = 0
+
+    def shutdown_workers(self):
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+            self._process_pool = None
+        if self._prefetch_pool is not None:
+            self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
+            self._prefetch_pool = None
+        if self._full_decode_pool is not None:
+            self._full_decode_pool.shutdown(wait=False, cancel_futures=True)
+            self._full_decode_pool = None
+
+    def export_to_shards(self):
+        if not self.folder_path:
+            self.status_var.set("No folder selected")
+            return
+        if self.shard_export_pending:
+            self.status_var.set("Shard export already running")
+            return
+        output_dir = os.path.join(self.folder_path, "shard_export")
+        os.makedirs(output_dir, exist_ok=True)
+        # Remove shards and indexes from earlier exports so globbing "train-*.tar" never picks up stale data
+        for name in os.listdir(output_dir):
+            if name.endswith(".tar") or name.endswith("_index.json"):
+                os.remove(os.path.join(output_dir, name))
+        with open(os.path.join(output_dir, "classes.txt"), 'w') as f:
+            f.write("\n".join(self.classes))
 
+        samples = {split: [] for split in SPLITS}
+        keys = set()
+        for img_file, rects, polygons, split in self.plan_export():
+            # WebDataset splits member names at the first dot, so keys must not contain one. The extension
+            # stays in the key so img.png and img.jpg remain separate samples.
+            key = base_key = img_file.replace(".", "_")
+            n = 1
+            while key in keys:
+                key = f"{base_key}_{n}"
+                n += 1
+            keys.add(key)
+            samples[split].append((key, os.path.join(self.folder_path, img_file), rects + polygon_rects(polygons)))
+        pool = self.get_process_pool()
+        self.shard_export_counts = {}
+        self.shard_export_errors = []
+        self.shard_export_excluded = self.export_excluded
+        for split, split_samples in samples.items():
+            future = pool.submit(_write_split_shards, output_dir, split, split_samples, self.shard_size_bytes)
+            self.shard_export_pending += 1
+            self.watch_future(future, lambda f, split=split: self.on_shards_exported(f, split))
+        self.status_var.set("Writing shards...")
+
+    def on_shards_exported(self, future, split):
+        self.shard_export_pending -= 1
+        try:
+            self.shard_export_counts[split] = future.result()[1]
+        except Exception as e:
+            self.shard_export_errors.append(f"{split}: {e}")
+        if self.shard_export_pending:
+            return
+        # A split that failed leaves an incomplete dataset, so that is reported instead of the counts
+        if self.shard_export_errors:
+            self.status_var.set(f"Error writing shards ({len(self.shard_export_errors)} splits failed): "
+                                f"{self.shard_export_errors[0]}")
+        else:
+            counts = ", ".join(f"{split}: {count}" for split, count in self.shard_export_counts.items())
+            self.status_var.set(f"Exported shards ({counts}) to {os.path.join(self.folder_path, 'shard_export')}"
+                                f"{self.excluded_note(self.shard_export_excluded)}")
+
+    def export_tiles(self):
+        if not self.folder_path:
+            self.status_var.set("No folder selected")
+            return
+        if self.tile_export_pending:
+            self.status_var.set("Tiled export already running")
+            return
+        output_dir = os.path.join(self.folder_path, "tiled_export")
+        for split in SPLITS:
+            reset_dirs(os.path.join(output_dir, "images", split), os.path.join(output_dir, "labels", split))
+
+        # Tiles inherit the split of their source image so overlapping crops never leak across splits
+        self.tile_export = {"output_dir": output_dir, "records": {split: [] for split in SPLITS}, "errors": []}
+        for img_file, rects, polygons, split in self.plan_export():
+            src_img = os.path.join(self.folder_path, img_file)
+            pool = self.get_process_pool() if can_stream_tiff(src_img) else self.get_full_decode_pool()
+            future = pool.submit(_export_image_tiles, src_img,
+                                 os.path.join(output_dir, "images", split), os.path.join(output_dir, "labels", split),
+                                 rects + polygon_rects(polygons), self.tile_size, self.tile_overlap, self.drop_empty_tiles.get(),
+                                 self.tile_min_visibility)
+            self.tile_export_pending += 1
+            self.watch_future(future, lambda f, split=split: self.on_tiles_exported(f, split))
+        self.tile_export["excluded"] = self.export_excluded
+        if not self.tile_export_pending:
+            self.status_var.set("No annotated images to export")
+            return
+        self.status_var.set(f"Tiling {self.tile_export_pending} images...")
+
+    def on_tiles_exported(self, future, split):
+        self.tile_export_pending -= 1
+        try:
+            self.tile_export["records"][split].extend(future.result())
+        except Exception as e:
+            self.tile_export["errors"].append(str(e))
+        if self.tile_export_pending:
+            self.status_var.set(f"Tiling {self.tile_export_pending} images...")
+            return
+        output_dir = self.tile_export["output_dir"]
+        with open(os.path.join(output_dir, "classes.txt"), 'w') as f:
+            f.write("\n".join(self.classes))
+        write_dataset_yaml(output_dir, self.classes)
+        # COCO annotations for the same tiles, one file per split
+        categories = [{"id": idx + 1, "name": cls, "supercategory": "none"} for idx, cls in enumerate(self.classes)]
+        total = 0
+        for split, records in self.tile_export["records"].items():
+            records.sort(key=lambda r: r["file_name"])
+            coco_data = {"images": [], "annotations": [], "categories": categories}
+            annotation_id = 1
+            for img_id, record in enumerate(records, start=1):
+                coco_data["images"].append({
+                    "id": img_id,
+                    "width": record["width"],
+                    "height": record["height"],
+                    "file_name": record["file_name"]
+                })
+                for class_id, x1, y1, x2, y2 in record["rects"]:
                     coco_data["annotations"].append({
                         "id": annotation_id,
-                        "image_id": img_id + 1,
-                        "category_id": self.classes.index(box["class"]) + 1,
-                        "bbox": [x1, y1, width, height],
-                        "area": width * height,
+                        "image_id": img_id,
+                        "category_id": class_id + 1,
+                        "bbox": [x1, y1, x2 - x1, y2 - y1],
+                        "area": (x2 - x1) * (y2 - y1),
                         "segmentation": [],
                         "iscrowd": 0
                     })
                     annotation_id += 1
-            except Exception as e:
-                self.status_var.set(f"Error processing {json_path}: {e}")
-                continue
-
-        with open(output_file, 'w') as f:
-            json.dump(coco_data, f, indent=2)
-
-        self.status_var.set(f"Exported annotations to COCO format in {output_dir}")
+            with open(os.path.join(output_dir, f"annotations_{split}.json"), 'w') as f:
+                json.dump(coco_data, f, indent=2)
+            total += len(records)
+        errors = self.tile_export["errors"]
+        failed = f", {len(errors)} images failed (first: {errors[0]})" if errors else ""
+        self.status_var.set(f"Exported {total} tiles to {output_dir}{failed}"
+                            f"{self.excluded_note(self.tile_export['excluded'])}")
 
     def quit(self):
         cv2.destroyAllWindows()
+        self.shutdown_workers()
         self.root.destroy()
 
     def run(self):
@@ -785,12 +2327,31 @@ class SimpleAnnotator:
                 if ((x - cx1)**2 + (y - cy1)**2) <= r**2:
                     found = ("circle", idx)
                     break
+        # Check polygons and rotated boxes
+        if not found:
+            for idx, polygon in enumerate(self.polygons):
+                if point_in_polygon(x, y, polygon["polygon"], polygon["bbox"]):
+                    found = ("polygon", idx)
+                    break
+        # Check pending proposals
+        if not found:
+            for idx, proposal in enumerate(self.current_proposals()):
+                (x1, y1), (x2, y2) = proposal["box"]
+                if min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2):
+                    found = ("proposal", idx)
+                    break
         self.selected_annotation = found
-        if found:
+        if found and found[0] == "proposal":
+            self.delete_selected_btn.config(state=tk.NORMAL)
+            self.accept_proposal_btn.config(state=tk.NORMAL)
+            self.status_var.set("Proposal selected. Accept it, or click delete to reject.")
+        elif found:
             self.delete_selected_btn.config(state=tk.NORMAL)
+            self.accept_proposal_btn.config(state=tk.DISABLED)
             self.status_var.set("Annotation selected. Click delete to remove.")
         else:
             self.delete_selected_btn.config(state=tk.DISABLED)
+            self.accept_proposal_btn.config(state=tk.DISABLED)
             self.status_var.set("No annotation selected.")
         # Start panning
         self.on_pan_start(event)